@@ -1,17 +1,30 @@
+import hashlib
+import math
+import re
 import webbrowser
+from datetime import datetime
 from threading import Timer
 
 import dash
-from dash import dcc, html, dash_table
+from dash import ctx, dcc, html, dash_table
 from dash.dependencies import Input, Output
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
+from flask import jsonify, request
+
+from metrics_index import METRIC_SUFFIXES, RESOLUTIONS, VISITOR_TYPES, MetricsIndex
 
 TABLE_ROWS = 20
 
-df = pd.read_feather('out/daily_metrics.feather')
+MAX_API_ROWS = 1000
+
+RESOLUTION_UNITS = {'hourly': 'hour', 'daily': 'day', 'weekly': 'week', 'monthly': 'month'}
+
+DATA_FILE = 'out/daily_metrics.feather'
+
+index = MetricsIndex.from_file(DATA_FILE)
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
 server = app.server
@@ -53,32 +66,42 @@ app.layout = dbc.Container([
     dcc.Graph(id="request_graph"),
     dash_table.DataTable(
         id='visit_table',
-        columns=[{"name": i, "id": i, 'presentation': 'markdown'}
-                 for i in ['Page', 'Human Visits', 'Bot Visits']],
-        sort_action="native",
+        columns=[{"name": 'Page', "id": 'Page', 'presentation': 'markdown'}] +
+                [{"name": i, "id": i, 'type': 'numeric'}
+                 for i in ['Human Visits', 'Bot Visits']],
+        page_action='custom',
+        page_current=0,
+        page_size=TABLE_ROWS,
+        sort_action='custom',
+        sort_mode='single',
+        sort_by=[{'column_id': 'Human Visits', 'direction': 'desc'}],
+        filter_action='custom',
+        filter_query='',
         data=None,
     ),
 ])
 
 
+def get_start_date(selected_days):
+    if selected_days == 0:
+        return None
+    # Matches selecting dates after (last date - selected_days).
+    return index.days[-1] - pd.Timedelta(days=selected_days - 1)
+
+
 @app.callback(
     Output("request_graph", "figure"),
     [Input("dropdown_duration", "value"),
      Input("data_type", "value")])
 def update_request_graph(selected_days, data_type):
-    if selected_days != 0:
-        cutoff_date = df["date"].iloc[-1] - pd.Timedelta(days=selected_days)
-        data = df[df['date'] > cutoff_date]
-    else:
-        data = df
-
-
-    gp = data.groupby([data['date'].dt.date])
+    start = get_start_date(selected_days)
+    resolution = index.pick_resolution(start, None)
 
     key_type = '_total_requests' if data_type == 'Requests' else '_unique_requests'
 
-    human_counts = gp['human' + key_type].sum()
-    bot_counts = gp['bot' + key_type].sum()
+    counts = index.rollup(resolution, start, None, ['human' + key_type, 'bot' + key_type])
+    human_counts = counts['human' + key_type]
+    bot_counts = counts['bot' + key_type]
 
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=human_counts.index, y=human_counts,
@@ -90,33 +113,188 @@ def update_request_graph(selected_days, data_type):
     fig.update_layout(
     title=f"{data_type} Trends",
     xaxis_title="Date",
-    yaxis_title=f"{data_type}/day",
+    yaxis_title=f"{data_type}/{RESOLUTION_UNITS[resolution]}",
     )
     return fig
 
 
+FILTER_OPERATORS = {'ge': '>=', 'le': '<=', 'lt': '<', 'gt': '>', 'ne': '!=', 'eq': '=',
+                    '>=': '>=', '<=': '<=', '<': '<', '>': '>', '!=': '!=', '=': '=',
+                    'contains': 'contains'}
+
+FILTER_PART = re.compile(r'\s*\{(?P<name>[^}]*)\}\s+(?P<operator>\S+)\s*(?P<value>.*?)\s*$')
+
+
+def split_filter_part(filter_part):
+    """
+    Parses one clause of a DataTable filter_query into (column, operator, value).
+    The operator is the token right after the column name, so operator words
+    inside the value are left alone. The value is returned as a string, it's up
+    to the caller to parse it for numeric columns.
+    """
+    match = FILTER_PART.match(filter_part)
+    if match is None:
+        return None, None, None
+
+    # DataTable prefixes operators with i/s for case (in)sensitive matching.
+    # Pages are matched as typed, so the flag is dropped.
+    operator = match['operator']
+    if operator not in FILTER_OPERATORS and operator[:1] in ('i', 's'):
+        operator = operator[1:]
+    if operator not in FILTER_OPERATORS:
+        return None, None, None
+
+    value = match['value']
+    v0 = value[0] if value else ''
+    if len(value) > 1 and v0 == value[-1] and v0 in ("'", '"', '`'):
+        value = value[1: -1].replace('\\' + v0, v0)
+
+    return match['name'], FILTER_OPERATORS[operator], value
+
+
 @app.callback(
     Output("visit_table", "data"),
+    Output("visit_table", "page_count"),
+    Output("visit_table", "page_current"),
     [Input("dropdown_duration", "value"),
-     Input("data_type", "value")])
-def update_visit_table(selected_days, data_type):
-    if selected_days != 0:
-        cutoff_date = df["date"].iloc[-1] - pd.Timedelta(days=selected_days)
-        data = df[df['date'] > cutoff_date]
-    else:
-        data = df
+     Input("data_type", "value"),
+     Input("visit_table", "page_current"),
+     Input("visit_table", "page_size"),
+     Input("visit_table", "sort_by"),
+     Input("visit_table", "filter_query")])
+def update_visit_table(selected_days, data_type, page_current, page_size, sort_by, filter_query):
+    key_type = '_total_requests' if data_type == 'Requests' else '_unique_requests'
+    column_keys = {'Page': 'page', 'Human Visits': 'human' + key_type, 'Bot Visits': 'bot' + key_type}
 
-    gp = data.groupby(['page'])
+    # Changing anything other than the page goes back to the first page.
+    if ctx.triggered_prop_ids and 'visit_table.page_current' not in ctx.triggered_prop_ids:
+        page_current = 0
 
+    table = index.page_table(get_start_date(selected_days), None,
+                             (column_keys['Human Visits'], column_keys['Bot Visits']))
+
+    page = None
+    prefix = None
+    contains = None
+    comparisons = []
+    for filter_part in (filter_query or '').split(' && '):
+        col_name, operator, value = split_filter_part(filter_part)
+        if col_name not in column_keys:
+            continue
+        if col_name == 'Page':
+            if operator == '=':
+                page = value
+            elif operator == 'contains':
+                # Pages all start with '/', so treat those searches as a prefix
+                # lookup and anything else as a substring search.
+                if value.startswith('/'):
+                    prefix = value
+                else:
+                    contains = value
+        elif operator != 'contains':
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if math.isfinite(value):
+                comparisons.append((column_keys[col_name], operator, value))
+
+    sort_column = None
+    descending = False
+    if sort_by:
+        sort_column = column_keys[sort_by[0]['column_id']]
+        descending = sort_by[0]['direction'] == 'desc'
+
+    mask = table.select(prefix, contains, comparisons, page)
+    page_count = max(1, -(-int(mask.sum()) // page_size))
+    page_current = min(page_current, page_count - 1)
+    pages, sums, _ = table.query(mask, sort_column, descending, page_current * page_size, page_size)
+
+    dict_data = [{'Page': f"[{page}](https://www.robopenguins.com{page})",
+                  'Human Visits': int(human), 'Bot Visits': int(bot)}
+                 for page, human, bot in zip(pages, sums[column_keys['Human Visits']], sums[column_keys['Bot Visits']])]
+
+    return dict_data, page_count, page_current
+
+
+class ApiError(Exception):
+    pass
+
+
+def parse_api_date(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ApiError(f'{name} must be formatted as YYYY-MM-DD')
+
+
+def parse_api_columns():
+    visitor = request.args.get('visitor', 'all')
+    metric = request.args.get('metric', 'requests')
+    if visitor != 'all' and visitor not in VISITOR_TYPES:
+        raise ApiError(f'visitor must be one of all, {", ".join(VISITOR_TYPES)}')
+    if metric not in METRIC_SUFFIXES:
+        raise ApiError(f'metric must be one of {", ".join(METRIC_SUFFIXES)}')
+    visitors = VISITOR_TYPES if visitor == 'all' else [visitor]
+    return tuple(v + METRIC_SUFFIXES[metric] for v in visitors)
+
+
+def cached_api_response(query):
+    """
+    Responses only depend on the query string and the data file version, so the
+    ETag is checked before doing any work. Computed results are memoized on the
+    index.
+    """
+    key = request.path + '?' + '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+    etag = hashlib.sha1(f'{index.version}:{key}'.encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = server.response_class(status=304)
+    else:
+        try:
+            response = jsonify(query())
+        except ApiError as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 400
+            return response
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
-    key_type = '_total_requests' if data_type == 'Requests' else '_unique_requests'
 
-    gp = gp.sum(numeric_only=True).sort_values('human' + key_type, ascending=False).head(20)
+@server.route('/api/timeseries')
+def api_timeseries():
+    def query():
+        start = parse_api_date('start')
+        end = parse_api_date('end')
+        prefix = request.args.get('prefix')
+        resolution = request.args.get('resolution', 'daily')
+        if resolution == 'auto':
+            # Page prefixes are only indexed by day.
+            resolution = 'daily' if prefix else index.pick_resolution(start, end)
+        elif resolution not in RESOLUTIONS:
+            raise ApiError(f'resolution must be one of auto, {", ".join(RESOLUTIONS)}')
+        try:
+            return index.timeseries(start, end, prefix, parse_api_columns(), resolution)
+        except ValueError as e:
+            raise ApiError(str(e))
+    return cached_api_response(query)
 
-    dict_data = [{'Page': f"[{i}](https://www.robopenguins.com{i})",
-                  'Human Visits': v['human' + key_type], 'Bot Visits': v['bot' + key_type]} for i, v in gp.iterrows()]
 
-    return dict_data
+@server.route('/api/top_pages')
+def api_top_pages():
+    def query():
+        try:
+            limit = int(request.args.get('limit', TABLE_ROWS))
+        except ValueError:
+            raise ApiError('limit must be an integer')
+        if not 0 < limit <= MAX_API_ROWS:
+            raise ApiError(f'limit must be between 1 and {MAX_API_ROWS}')
+        return index.top_pages(parse_api_date('start'), parse_api_date('end'),
+                               request.args.get('prefix'), parse_api_columns(), limit)
+    return cached_api_response(query)
 
 
 def open_browser():
@@ -7,13 +7,16 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from functools import reduce
 from multiprocessing import Pool, Queue
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import boto3
+import botocore.exceptions
+import numpy as np
 import pandas as pd
 from ua_parser import user_agent_parser
 
 from extended_log import load_extended_log_files, load_extended_log_s3, s3_url_to_parts
+from metrics_index import COUNTER_COLUMNS, HOURLY, ROLLUP_PERIODS, get_rollup_location
 
 OUT_FILE = "daily_metrics.feather"
 
@@ -23,6 +26,9 @@ NUM_THREADS = 8
 
 FALLBACK_START_DATE = datetime(year=2023, month=1, day=1)
 
+# Candidate counter widths, narrowest first.
+COUNTER_DTYPES = ["uint8", "uint16", "uint32", "uint64"]
+
 
 @dataclass
 class MetricsByDateAndPage:
@@ -34,12 +40,22 @@ class MetricsByDateAndPage:
     bot_unique_requests: int = 0
 
 
+@dataclass
+class MetricsByHour:
+    date: datetime
+    human_total_requests: int = 0
+    human_unique_requests: int = 0
+    bot_total_requests: int = 0
+    bot_unique_requests: int = 0
+
+
 def process_func(files: str):
     if len(files) == 0:
-        return []
+        return [], []
     current_date = get_date(files[0])
     days_files = []
     metrics = []
+    hourly_metrics = []
     for file in files:
         new_date = get_date(file)
         if new_date == current_date:
@@ -51,17 +67,20 @@ def process_func(files: str):
         current_datetime = datetime(
             current_date.year, current_date.month, current_date.day
         )
-        metrics += extract_analytic_data(current_datetime, df).values()
+        page_data, hour_data = extract_analytic_data(current_datetime, df)
+        metrics += page_data.values()
+        hourly_metrics += hour_data.values()
 
         current_date = new_date
         days_files = [file]
 
-    return metrics
+    return metrics, hourly_metrics
 
 
 def process_s3_func(args, start_date: datetime.date):
     date = start_date
     metrics = []
+    hourly_metrics = []
     while date < datetime.now().date():
         prefix = args.prefix + date.strftime("%Y-%m-%d")
         print(f'Processing {date.strftime("%Y-%m-%d")}')
@@ -69,10 +88,12 @@ def process_s3_func(args, start_date: datetime.date):
         if df is not None:
             # Pandas only infers correct type for datetime.datetime (not datetime.date)
             current_datetime = datetime(date.year, date.month, date.day)
-            metrics += extract_analytic_data(current_datetime, df).values()
+            page_data, hour_data = extract_analytic_data(current_datetime, df)
+            metrics += page_data.values()
+            hourly_metrics += hour_data.values()
         date += timedelta(days=NUM_THREADS)
 
-    return metrics
+    return metrics, hourly_metrics
 
 
 def get_date(file: str) -> datetime.date:
@@ -82,10 +103,12 @@ def get_date(file: str) -> datetime.date:
 
 def extract_analytic_data(
     date: datetime, df: pd.DataFrame
-) -> Dict[str, MetricsByDateAndPage]:
+) -> Tuple[Dict[str, MetricsByDateAndPage], Dict[int, MetricsByHour]]:
     df = df[(df["cs-uri-stem"].str.endswith("/")) & (df["sc-status"] == 200)]
 
     data: Dict[str, MetricsByDateAndPage] = {}
+    hours: Dict[int, MetricsByHour] = {}
+    day = date.strftime("%Y-%m-%d")
     ips: Dict[str, set] = defaultdict(set)
 
     for _, row in df.iterrows():
@@ -93,6 +116,17 @@ def extract_analytic_data(
         ip = row["c-ip"]
         if page not in data:
             data[page] = MetricsByDateAndPage(date=date, page=page)
+        # Like the daily metrics, requests are attributed to the day of the log
+        # file. The first file of a day often has requests from the end of the
+        # previous day, those are counted in the first hour (and any from the
+        # next day in the last hour) so the hourly buckets sum to the daily
+        # values. Unique requests are attributed to the hour of the first visit.
+        if row["date"] == day:
+            hour = int(row["time"][:2])
+        else:
+            hour = 0 if row["date"] < day else 23
+        if hour not in hours:
+            hours[hour] = MetricsByHour(date=date + timedelta(hours=hour))
 
         ua_string = urllib.parse.unquote(row["cs(User-Agent)"])
         ua_data = user_agent_parser.Parse(ua_string)
@@ -103,15 +137,17 @@ def extract_analytic_data(
         if is_uninque:
             ips[page].add(ip)
 
-        if is_bot(device_data, os_data, agent_data):
-            data[page].bot_total_requests += 1
-            if is_uninque:
-                data[page].bot_unique_requests += 1
-        else:
-            data[page].human_total_requests += 1
-            if is_uninque:
-                data[page].human_unique_requests += 1
-    return data
+        bot = is_bot(device_data, os_data, agent_data)
+        for metrics in (data[page], hours[hour]):
+            if bot:
+                metrics.bot_total_requests += 1
+                if is_uninque:
+                    metrics.bot_unique_requests += 1
+            else:
+                metrics.human_total_requests += 1
+                if is_uninque:
+                    metrics.human_unique_requests += 1
+    return data, hours
 
 
 def is_bot(c_device, c_os, c_agent) -> bool:
@@ -156,11 +192,17 @@ def get_cache_df(cache_location):
     cache_df = None
     cache_bucket, cache_key = s3_url_to_parts(cache_location)
     if cache_key:
-        print("Loaded cache from S3")
         s3_client = boto3.client("s3")
-        response = s3_client.get_object(Bucket=cache_bucket, Key=cache_key)
+        try:
+            response = s3_client.get_object(Bucket=cache_bucket, Key=cache_key)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            print(f"No cache at {cache_location}")
+            return None
         stream = io.BytesIO(response["Body"].read())
         cache_df = pd.read_feather(stream)
+        print("Loaded cache from S3")
     elif os.path.exists(cache_location):
         print("Loaded cache from File")
         cache_df = pd.read_feather(cache_location)
@@ -182,14 +224,15 @@ def s3_generator(args):
     params = [(args, start_date + timedelta(days=i)) for i in range(NUM_THREADS)]
 
     with Pool(NUM_THREADS) as p:
-        metrics = p.starmap(process_s3_func, params)
+        results = p.starmap(process_s3_func, params)
 
-    save_metrics(old_df, metrics, args)
+    save_metrics(old_df, results, args)
 
 
-def save_metrics(old_df, metrics, args):
+def save_metrics(old_df, results, args):
     out_path = os.path.join(args.out_dir, OUT_FILE) 
-    metrics = reduce(lambda x, y: x + y, metrics, [])
+    metrics = reduce(lambda x, y: x + y, [m for m, _ in results], [])
+    hourly_metrics = reduce(lambda x, y: x + y, [h for _, h in results], [])
     if len(metrics) == 0:
         print('No logs found.')
         return
@@ -197,16 +240,16 @@ def save_metrics(old_df, metrics, args):
 
     df = pd.DataFrame(metrics)
     df["date"] = pd.to_datetime(df["date"])
-    df["human_total_requests"] = df["human_total_requests"].astype("uint16")
-    df["human_unique_requests"] = df["human_unique_requests"].astype("uint16")
-    df["bot_total_requests"] = df["bot_total_requests"].astype("uint16")
-    df["bot_unique_requests"] = df["bot_unique_requests"].astype("uint16")
+    df["page"], old_pages = encode_pages(df["page"], None if old_df is None else old_df["page"])
+    if old_df is not None:
+        old_df["page"] = old_pages
+    df, old_df = compact_counters(df, old_df)
 
     print(f"{len(df)} new metrics")
+    new_start = df["date"].min()
 
     if old_df is not None:
         df = pd.concat([old_df, df])
-    df["page"] = df["page"].astype("category")
 
     size_all = len(df)
 
@@ -218,16 +261,121 @@ def save_metrics(old_df, metrics, args):
 
     df.info()
 
+    # The daily cache decides which days are processed next run, so it's
+    # written last. If saving a rollup fails, the days are processed again.
+    save_hourly_metrics(hourly_metrics, last_day, args)
+    save_rollups(df, new_start, args)
+
     # df.to_csv(OUT_FILE,  index=False)
     df.to_feather(out_path)
+    upload_cache_file(out_path, args.cache)
+
+
+def get_counter_dtype(max_value) -> str:
+    for dtype in COUNTER_DTYPES:
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    raise OverflowError(f"Counter value {max_value} doesn't fit in {COUNTER_DTYPES[-1]}")
+
+
+def compact_counters(df, old_df=None):
+    """
+    Casts each counter column of df and old_df to the narrowest unsigned type
+    that holds the largest value in either, so appending new data promotes the
+    column instead of wrapping.
+    """
+    for column in COUNTER_COLUMNS:
+        max_value = max(
+            [int(d[column].max()) for d in (df, old_df) if d is not None and len(d) > 0],
+            default=0,
+        )
+        dtype = get_counter_dtype(max_value)
+        if old_df is not None and old_df[column].dtype != dtype:
+            print(f"Converting {column} from {old_df[column].dtype} to {dtype}")
+            old_df[column] = old_df[column].astype(dtype)
+        df[column] = df[column].astype(dtype)
+    return df, old_df
+
+
+def encode_pages(pages, old_pages=None):
+    """
+    Encodes pages with the categories from the existing cache, appending any new
+    pages to the end. The codes of known pages never change between runs, and
+    both results share a dtype so concatenating them doesn't re-encode.
+    """
+    if old_pages is None:
+        categories = pd.Index([], dtype=pages.dtype)
+    else:
+        old_pages = old_pages.astype("category")
+        categories = old_pages.cat.categories
+    new_pages = pd.Index(pages.unique()).difference(categories)
+    dtype = pd.CategoricalDtype(categories.append(new_pages))
+    if old_pages is not None:
+        old_pages = old_pages.cat.set_categories(dtype.categories)
+    return pages.astype(dtype), old_pages
 
-    cache_bucket, cache_key = s3_url_to_parts(args.cache)
+
+def upload_cache_file(out_path, cache_location):
+    cache_bucket, cache_key = s3_url_to_parts(cache_location)
     if cache_key:
-        print("Uploading cache file to S3")
+        print(f"Uploading {cache_key} to S3")
         s3 = boto3.resource('s3')
         s3.Bucket(cache_bucket).upload_file(out_path, cache_key)
 
 
+def save_hourly_metrics(hourly_metrics, last_day, args):
+    out_path = get_rollup_location(os.path.join(args.out_dir, OUT_FILE), HOURLY)
+    cache_location = get_rollup_location(args.cache, HOURLY)
+
+    df = pd.DataFrame(hourly_metrics, columns=["date"] + COUNTER_COLUMNS)
+    df["date"] = pd.to_datetime(df["date"])
+
+    old_df = get_cache_df(cache_location)
+    if old_df is not None and len(df) > 0:
+        # The day dropped as incomplete on the last run is processed again.
+        old_df = old_df[old_df["date"] < df["date"].min().normalize()].copy()
+    df, old_df = compact_counters(df, old_df)
+    if old_df is not None:
+        df = pd.concat([old_df, df])
+
+    df = df[df["date"] < last_day].sort_values("date", kind="stable")
+    df.reset_index(drop=True, inplace=True)
+
+    print(f"{len(df)} hourly metrics")
+    df.to_feather(out_path)
+    upload_cache_file(out_path, cache_location)
+
+
+def save_rollups(df, new_start, args):
+    """
+    Only the periods overlapping the newly added days are recomputed from the
+    daily metrics, older periods are kept from the existing rollup.
+    """
+    for resolution, freq in ROLLUP_PERIODS.items():
+        out_path = get_rollup_location(os.path.join(args.out_dir, OUT_FILE), resolution)
+        cache_location = get_rollup_location(args.cache, resolution)
+
+        old_rollup = get_cache_df(cache_location)
+        if old_rollup is None:
+            update_start = df["date"].min()
+        else:
+            update_start = new_start.to_period(freq).start_time
+            old_rollup = old_rollup[old_rollup["date"] < update_start].copy()
+
+        data = df[df["date"] >= update_start]
+        periods = data["date"].dt.to_period(freq).dt.start_time.rename("date")
+        rollup = data.groupby(periods)[COUNTER_COLUMNS].sum().reset_index()
+        rollup, old_rollup = compact_counters(rollup, old_rollup)
+
+        if old_rollup is not None:
+            rollup = pd.concat([old_rollup, rollup])
+        rollup.reset_index(drop=True, inplace=True)
+
+        print(f"{len(rollup)} {resolution} metrics")
+        rollup.to_feather(out_path)
+        upload_cache_file(out_path, cache_location)
+
+
 def local_generator(args):
     path_arg = args.local_logs
 
@@ -271,9 +419,9 @@ def local_generator(args):
         return
 
     with Pool(NUM_THREADS) as p:
-        metrics = p.map(process_func, file_allocations)
+        results = p.map(process_func, file_allocations)
 
-    save_metrics(old_df, metrics, args)
+    save_metrics(old_df, results, args)
 
 
 if __name__ == "__main__":
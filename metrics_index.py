@@ -0,0 +1,301 @@
+import os
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+COUNTER_COLUMNS = [
+    "human_total_requests",
+    "human_unique_requests",
+    "bot_total_requests",
+    "bot_unique_requests",
+]
+
+VISITOR_TYPES = ["human", "bot"]
+
+HOURLY = "hourly"
+
+DAILY = "daily"
+
+# Pandas period frequencies for the rollups materialized by the generator.
+ROLLUP_PERIODS = {"weekly": "W", "monthly": "M"}
+
+RESOLUTIONS = {
+    HOURLY: pd.Timedelta(hours=1),
+    DAILY: pd.Timedelta(days=1),
+    "weekly": pd.Timedelta(weeks=1),
+    "monthly": pd.Timedelta(days=30),
+}
+
+MAX_SERIES_POINTS = 400
+
+METRIC_SUFFIXES = {"requests": "_total_requests", "unique": "_unique_requests"}
+
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+
+def get_rollup_location(location: str, resolution: str) -> str:
+    root, ext = os.path.splitext(location)
+    return f"{root}_{resolution}{ext}"
+
+
+def get_data_version(path: str) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+class MetricsIndex:
+    """
+    Read only view of the daily metrics with the lookups the dashboard and API
+    need precomputed. Rows are sorted by date so a date range is a slice, and
+    the page categories are sorted so a page prefix is a contiguous range of
+    category codes.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        version: str,
+        rollups: Optional[Dict[str, pd.DataFrame]] = None,
+    ):
+        self.version = version
+        df = df.sort_values("date", kind="stable").reset_index(drop=True)
+        df["page"] = df["page"].astype("category")
+        self.df = df
+
+        self.dates = df["date"].to_numpy()
+        self.days = np.unique(self.dates)
+        self.day_idx = np.searchsorted(self.days, self.dates)
+
+        categories = df["page"].cat.categories.to_numpy(dtype=object)
+        order = np.argsort(categories, kind="stable")
+        self.pages = categories
+        self.sorted_pages = categories[order]
+        self.sorted_page_codes = order
+        self.page_codes = df["page"].cat.codes.to_numpy()
+
+        self.counters = {c: df[c].to_numpy(dtype=np.int64) for c in COUNTER_COLUMNS}
+        self.daily_totals = df.groupby("date")[COUNTER_COLUMNS].sum()
+
+        # Totals per time bucket, indexed by the bucket start. Rollups missing
+        # from an older cache are built from the daily totals, except hourly
+        # which can only come from the generator.
+        self.rollups = {DAILY: self.daily_totals}
+        for resolution, freq in ROLLUP_PERIODS.items():
+            periods = self.daily_totals.index.to_period(freq).start_time.rename("date")
+            self.rollups[resolution] = self.daily_totals.groupby(periods).sum()
+        for resolution, rollup in (rollups or {}).items():
+            self.rollups[resolution] = rollup.set_index("date")[COUNTER_COLUMNS].sort_index()
+
+    @classmethod
+    def from_file(cls, path: str) -> "MetricsIndex":
+        rollups = {}
+        for resolution in [HOURLY, *ROLLUP_PERIODS]:
+            rollup_path = get_rollup_location(path, resolution)
+            if os.path.exists(rollup_path):
+                rollups[resolution] = pd.read_feather(rollup_path)
+        return cls(pd.read_feather(path), get_data_version(path), rollups)
+
+    def pick_resolution(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> str:
+        """
+        Finest available resolution that covers the range in at most
+        MAX_SERIES_POINTS buckets. Hourly metrics only exist from when the
+        generator started writing them, so a rollup is skipped if it starts
+        after the requested range.
+        """
+        start = max(pd.Timestamp(self.days[0]), pd.Timestamp(self.days[0] if start is None else start))
+        end = pd.Timestamp(self.days[-1] if end is None else end)
+        span = end - start + pd.Timedelta(days=1)
+        available = [
+            r for r in RESOLUTIONS
+            if r in self.rollups and len(self.rollups[r]) > 0
+            and self.rollups[r].index[0].normalize() <= start
+        ]
+        for resolution in available:
+            if span / RESOLUTIONS[resolution] <= MAX_SERIES_POINTS:
+                return resolution
+        return available[-1]
+
+    def rollup(
+        self,
+        resolution: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        columns: Sequence[str],
+    ) -> pd.DataFrame:
+        """
+        Buckets overlapping the days from start to end, inclusive.
+        """
+        rollup = self.rollups[resolution]
+        if start is not None and resolution in ROLLUP_PERIODS:
+            start = pd.Timestamp(start).to_period(ROLLUP_PERIODS[resolution]).start_time
+        if end is not None:
+            end = pd.Timestamp(end) + pd.Timedelta(days=1) - pd.Timedelta(1, "ns")
+        return rollup.loc[start:end, list(columns)]
+
+    def date_slice(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> slice:
+        lo = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start), "left")
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end), "right")
+        return slice(int(lo), int(hi))
+
+    def prefix_codes(self, prefix: str) -> np.ndarray:
+        lo = np.searchsorted(self.sorted_pages, prefix, "left")
+        hi = np.searchsorted(self.sorted_pages, prefix + "\U0010ffff", "left")
+        return self.sorted_page_codes[lo:hi]
+
+    def _row_mask(self, rows: slice, prefix: Optional[str]) -> Optional[np.ndarray]:
+        if not prefix:
+            return None
+        page_mask = np.zeros(len(self.pages), dtype=bool)
+        page_mask[self.prefix_codes(prefix)] = True
+        return page_mask[self.page_codes[rows]]
+
+    @lru_cache(maxsize=256)
+    def timeseries(
+        self,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        prefix: Optional[str],
+        columns: tuple,
+        resolution: str = DAILY,
+    ) -> List[Dict]:
+        if prefix and resolution != DAILY:
+            raise ValueError("Page prefixes are only supported at daily resolution")
+        if resolution not in self.rollups:
+            raise ValueError(f"No {resolution} metrics available")
+
+        if not prefix:
+            totals = self.rollup(resolution, start, end, columns)
+        else:
+            rows = self.date_slice(start, end)
+            mask = self._row_mask(rows, prefix)
+            day_idx = self.day_idx[rows][mask]
+            totals = pd.DataFrame(
+                {
+                    c: np.bincount(
+                        day_idx,
+                        weights=self.counters[c][rows][mask],
+                        minlength=len(self.days),
+                    ).astype(np.int64)
+                    for c in columns
+                },
+                index=pd.DatetimeIndex(self.days, name="date"),
+            ).loc[start:end]
+
+        date_format = "%Y-%m-%dT%H:00" if resolution == HOURLY else "%Y-%m-%d"
+        return [
+            {"date": d.strftime(date_format), **{c: int(v) for c, v in zip(columns, values)}}
+            for d, values in zip(totals.index, totals.itertuples(index=False))
+        ]
+
+    @lru_cache(maxsize=32)
+    def page_table(
+        self,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        columns: tuple,
+    ) -> "PageTable":
+        rows = self.date_slice(start, end)
+        codes = self.page_codes[rows]
+        sums = {
+            c: np.bincount(codes, weights=self.counters[c][rows], minlength=len(self.pages)).astype(np.int64)
+            for c in columns
+        }
+        # Keep the pages with activity in the range, in sorted page order.
+        active = sum(sums.values())[self.sorted_page_codes] > 0
+        order = self.sorted_page_codes[active]
+        return PageTable(self.pages[order], {c: v[order] for c, v in sums.items()})
+
+    @lru_cache(maxsize=256)
+    def top_pages(
+        self,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        prefix: Optional[str],
+        columns: tuple,
+        limit: int,
+    ) -> List[Dict]:
+        # Ranked by the total of the selected columns, so with both visitor
+        # types a page with only bot traffic still ranks by its requests.
+        table = self.page_table(start, end, columns)
+        pages, sums, _ = table.query(table.select(prefix=prefix), columns, True, 0, limit)
+        return [
+            {"page": page, **{c: int(sums[c][i]) for c in columns}}
+            for i, page in enumerate(pages)
+        ]
+
+
+class PageTable:
+    """
+    Per page aggregates for one date range and set of counters, sorted by page
+    so prefix searches are a binary search.
+    """
+
+    def __init__(self, pages: np.ndarray, sums: Dict[str, np.ndarray]):
+        self.pages = pages
+        self.sums = sums
+        self.page_index = pd.Index(pages)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def select(
+        self,
+        prefix: Optional[str] = None,
+        contains: Optional[str] = None,
+        comparisons: Sequence[Tuple[str, str, float]] = (),
+        page: Optional[str] = None,
+    ) -> np.ndarray:
+        mask = np.ones(len(self.pages), dtype=bool)
+        if page is not None:
+            lo = np.searchsorted(self.pages, page, "left")
+            hi = np.searchsorted(self.pages, page, "right")
+            mask[:lo] = False
+            mask[hi:] = False
+        if prefix:
+            lo = np.searchsorted(self.pages, prefix, "left")
+            hi = np.searchsorted(self.pages, prefix + "\U0010ffff", "left")
+            mask[:lo] = False
+            mask[hi:] = False
+        if contains:
+            mask &= self.page_index.str.contains(contains, regex=False)
+        for column, op, value in comparisons:
+            mask &= COMPARISONS[op](self.sums[column], value)
+        return mask
+
+    def query(
+        self,
+        mask: np.ndarray,
+        sort_column: Union[str, Sequence[str], None],
+        descending: bool,
+        offset: int,
+        limit: int,
+    ) -> Tuple[np.ndarray, Dict[str, np.ndarray], int]:
+        """
+        Returns the pages and sums for the requested window of the selected
+        rows, along with the total number of selected rows. Sorting by several
+        columns sorts by their total.
+        """
+        rows = np.flatnonzero(mask)
+        if sort_column is None or sort_column == "page":
+            if descending:
+                rows = rows[::-1]
+        else:
+            sort_columns = [sort_column] if isinstance(sort_column, str) else sort_column
+            values = sum(self.sums[c][rows] for c in sort_columns)
+            rows = rows[np.argsort(-values if descending else values, kind="stable")]
+        rows = rows[offset:offset + limit]
+        return self.pages[rows], {c: v[rows] for c, v in self.sums.items()}, int(mask.sum())